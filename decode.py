@@ -3,9 +3,8 @@
 import os
 import numpy as np
 import sys
-import json
 import gzip
-import re
+import struct
 import argparse
 import time
 
@@ -40,70 +39,91 @@ making each data segment self-correcting with one of many such algorithms.
 """
 
 
-def decode(encoded_data):
-    component_occurrences = []
-    for i, bundle in enumerate(encoded_data):
-        bundle_components = bundle["components"]
-        for component in bundle_components:
-            if component >= len(component_occurrences):
-                for _ in range(component - len(component_occurrences) + 1):
-                    component_occurrences.append([])
-            component_occurrences[component].append(i)
-
-    # First, initialize the decoded_data list as a list of -1s with length equal to the number of original bundles.
-    # Since we XORed unsigned integers together, the values of encoded blocks should NEVER be negative. Thus,
-    # initializing the decoded_data list with -1s gives an easy way to check whether an original bundle has been solved.
-    decoded_data = []
-
-    # Iterate through the encoded_data. If the current encoded bundle has 1 component left, it does not need to wait for
-    # any other bundles to be processed before it can be considered solved. If the decoded_data bundle we're looking at
-    # is unsolved, its value is added to the decoded_data at the appropriate index. Afterwards, we iterate through the
-    # rest of the encoded_data bundles to see if any of them used the solved decoded_data as a component. Upon finding
-    # such a bundle, we can't assign any new decoded_data values, but we can update the bundle's value by XORing it with
-    # the newly-decoded bundle's value. The component can then be considered to have been "removed" from the encoded
-    # bundle, so we remove it from the bundle's component list.
-
-    solved = -1  # Python doesn't have "do-while", so we need to initialize this solved variable here. Can't use "None".
-    while solved != 0:
-        solved = 0
-        for i, bundle in enumerate(encoded_data):
-            if bundle is None:
-                continue
-
-            if len(bundle["components"]) == 1:
-                component_index = bundle["components"][0]
-                encoded_data[i] = None
-
-                if component_index >= len(decoded_data):
-                    for _ in range(component_index - len(decoded_data) + 1):
-                        decoded_data.append(-1)
-
-                cur_decode = decoded_data[component_index]
-
-
-                # Encoding results in some elements of decoded_data being ints and others being numpy arrays. Here, we
-                # would only need the sum of the numpy array as a way to generate an integer to represent it. We're
-                # just checking to make sure that the decoded_data entry we're looking at isn't already solved for
-                # efficiency purposes.
-                if not isinstance(cur_decode, int):
-                    cur_decode = sum(cur_decode)
-
-                if cur_decode < 0:
-                    cur_value = bundle["value"]
-                    decoded_data[component_index] = cur_value
-
-                    solved += 1
-
-                    cur_component_occurrences = component_occurrences[component_index]
-
-                    for j in cur_component_occurrences:
-                        other_bundle = encoded_data[j]
-                        if other_bundle is None:
-                            continue
-
-                        if len(other_bundle["components"]) > 1:
-                            other_bundle["value"] = cur_value ^ other_bundle["value"]
-                            other_bundle["components"].remove(component_index)
+def read_gzip(filename):
+    # The uncompressed size of a gzip file is stored, modulo 2**32, in its last four bytes. The buffer is allocated with
+    # that size up front and the file is decompressed straight into it, rather than letting GzipFile.read() collect
+    # chunks and join them into a second full copy. GzipFile.readinto() decompresses into a temporary of the requested
+    # size before copying it over, so the buffer is filled at most 1 MiB at a time. Once the buffer is full, a single
+    # byte is read to check for the end of the file, and only if there is more data (files of 4 GiB or more) is the
+    # buffer grown, 1 MiB at a time so that growing it never needs a temporary as large as the data read so far.
+
+    # The stored size is not trusted on its own: a truncated or corrupted file can claim up to 4 GiB, which would be
+    # allocated before gzip notices the damage. Deflate never expands data by more than a factor of 1032, so the buffer
+    # is never allocated larger than that multiple of the compressed size.
+    with open(filename, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        buffer = bytearray(min(struct.unpack("<I", f.read(4))[0], os.path.getsize(filename) * 1032))
+
+    length = 0
+    with gzip.open(filename, "rb") as f:
+        while True:
+            if length == len(buffer):
+                extra = f.read(1)
+                if not extra:
+                    break
+                buffer += extra
+                buffer.extend(bytes(1 << 20))
+                length += 1
+            read = f.readinto(memoryview(buffer)[length:length + (1 << 20)])
+            if not read:
+                break
+            length += read
+
+    del buffer[length:]
+    return buffer
+
+
+def decode(values, comp_indptr, comp_indices, original_size):
+    # The peeling state is kept in flat numpy arrays. values holds the value of every encoded bundle as one row of a
+    # contiguous 2-D array and is modified in place, so eliminating a solved component from every bundle that contains
+    # it becomes one XOR over a slice of rows instead of one Python XOR per bundle.
+
+    # The components of encoded bundle i are comp_indices[comp_indptr[i]:comp_indptr[i + 1]]. The number of unsolved
+    # components of each bundle is tracked in degrees, so components never have to be removed from any list. Alongside
+    # it, remaining holds the XOR of the indices of each bundle's unsolved components; once a bundle is down to one
+    # unsolved component, remaining is exactly that component's index, so the peeling loop never has to look at the
+    # component lists again.
+    degrees = np.diff(comp_indptr).astype(np.int32)
+    remaining = np.bitwise_xor.reduceat(comp_indices, comp_indptr[:-1])
+
+    # The inverse index maps each original bundle to the encoded bundles that used it as a component, stored in the same
+    # CSR layout: the encoded bundles containing component c are col_indices[col_indptr[c]:col_indptr[c + 1]].
+    col_indptr = np.zeros(original_size + 1, dtype=np.int32)
+    np.cumsum(np.bincount(comp_indices, minlength=original_size), out=col_indptr[1:])
+    col_indices = np.repeat(np.arange(len(values), dtype=np.int32), degrees)[
+        np.argsort(comp_indices, kind="stable")]
+
+    decoded_data = np.zeros((original_size, values.shape[1]), dtype=values.dtype)
+
+    # The ripple is the stack of encoded bundles with exactly one unsolved component left. Such a bundle does not need to
+    # wait for any other bundles to be processed before it can be considered solved: its value IS the value of its last
+    # component. Afterwards, every encoded bundle that used the newly-solved component has its value XORed with the
+    # solved value and its degree decremented, which "removes" the component from it. Any bundle whose degree drops to 1
+    # joins the ripple, so the whole decode is a single pass over the ripple.
+    ripple = np.flatnonzero(degrees == 1).tolist()
+    solved = 0
+    while ripple:
+        i = ripple.pop()
+
+        # A bundle can drop to degree 0 while waiting in the ripple if another bundle solved its last component first.
+        if degrees[i] != 1:
+            continue
+
+        component_index = remaining[i]
+        decoded_data[component_index] = values[i]
+        solved += 1
+
+        rows = col_indices[col_indptr[component_index]:col_indptr[component_index + 1]]
+        values[rows] ^= decoded_data[component_index]
+        remaining[rows] ^= component_index
+        degrees[rows] -= 1
+        ripple.extend(rows[degrees[rows] == 1].tolist())
+
+    # Every original bundle is solved at most once, so if the ripple died out before solved reached original_size, some
+    # original bundles were never recovered and decoded_data still holds zeros in their place. Returning None instead
+    # keeps those zeros from ever being written out as if they were the original data.
+    if solved < original_size:
+        return None
 
     return decoded_data
 
@@ -123,9 +143,10 @@ def main():
     DATATYPE = np.uint64 if not args.x86 else np.uint32
 
     # Each bundle from the encoded data file is already the correct bundle size, so we do not need to worry about
-    # each segment read below being the same size. The entire file is read into a string, which is then decoded from
-    # bytes and split into individual bundles using regex. Each individual bundle is still a string, so we load them
-    # into dictionaries.
+    # each segment read below being the same size. The entire file is read into a bytes buffer, which is then split
+    # into individual bundles using the binary header in front of each one. The components and value of each bundle
+    # are numpy views directly into that buffer, so no text is ever parsed. Every header also carries the number of
+    # original bundles, so the decoder knows how many it has to recover even if the last one was never received.
 
     file_list = []
 
@@ -135,54 +156,80 @@ def main():
         for file in os.listdir(args.input_filename):
             file_list.append(os.path.join(args.input_filename, file))
 
+    failed = False
+
     print(f"<decoder> setup finished!")
 
     for filename in file_list:
         print(f"<decoder> reading file {filename}...")
-        with gzip.open(filename, "rb") as f:
-            bundle_list = f.read()
-
-        bundle_list = bundle_list.decode()
-        bundles = re.findall(r'\{.*?\}', bundle_list)
-
-        data = []
-        for bundle in bundles:
-            bundle = json.loads(bundle)
-
-            # Bundle values were stored as lists instead of numpy arrays so that the decoder can read them. Now that they
-            # have been parsed, they can be converted back into numpy arrays.
-            bundle["value"] = np.array(bundle["value"], dtype=DATATYPE)
-            data.append(bundle)
+        bundle_list = read_gzip(filename)
+
+        values = []
+        components = []
+        original_size = 0
+        offset = 0
+        while offset < len(bundle_list):
+            component_count, value_bytes, original_size = struct.unpack_from("<III", bundle_list, offset)
+            offset += struct.calcsize("<III")
+
+            components.append(np.frombuffer(bundle_list, dtype="<i4", count=component_count, offset=offset))
+            offset += 4 * component_count
+
+            values.append(np.frombuffer(bundle_list, dtype=DATATYPE, count=value_bytes // np.dtype(DATATYPE).itemsize,
+                                        offset=offset))
+            offset += value_bytes
+
+        # An empty input file cannot be encoded, so an encoded file without any bundles always means that every bundle
+        # was lost in transmission, and there is nothing to decode the original file from.
+        if not values:
+            print(f"<decoder> error: no encoded bundles were received in {filename}, skipping it", file=sys.stderr)
+            failed = True
+            continue
+
+        # The encoded bundles are handed to the decoder as one 2-D array of values with one row per bundle, and their
+        # components flattened into a compressed sparse row (CSR) layout: the components of bundle i are
+        # comp_indices[comp_indptr[i]:comp_indptr[i + 1]]. The offsets use np.intp, numpy's native index type, because
+        # reduceat only accepts offsets it can safely cast to it, and np.intp is only 32 bits wide on 32-bit platforms.
+        values = np.stack(values)
+        comp_indptr = np.zeros(len(components) + 1, dtype=np.intp)
+        np.cumsum([len(bundle_components) for bundle_components in components], out=comp_indptr[1:])
+        comp_indices = np.concatenate(components).astype(np.int32, copy=False)
 
         print(f"<decoder> setup finished!\n<decoder> decoding {filename}...")
 
         start = time.time()
-        decoded_data = decode(data)
+        decoded_data = decode(values, comp_indptr, comp_indices, original_size)
         end = time.time()
 
+        if decoded_data is None:
+            print(f"<decoder> error: not enough encoded bundles were received to decode {filename}, skipping it",
+                  file=sys.stderr)
+            failed = True
+            continue
+
         filename = os.path.basename(filename).replace("encodefile_", "").replace(".gz", "")
         print(f"<decoder> data decoded! elapsed time: {round((end - start) * 1000, 1)} ms\n<decoder> writing decoded data to {args.output_directory}/{filename}...")
         # print(f"\n\n\nDECODED DATA: \n{decoded_data}")
 
-        # Recompile the decoded_data bundles into an output file.
+        # Recompile the decoded_data bundles into an output file. The decoded bundles are the rows of one contiguous
+        # array, so everything but the last bundle can be written straight from that array without any copies.
 
         if not os.path.exists(args.output_directory):
             os.makedirs(args.output_directory)
 
-        with open("temp_outfile", "wb") as f:
-            for bundle in decoded_data:
-                f.write(bundle)
-
-        # Remember that we padded the end of our original file with zeros, so we strip them off. A more intelligent
-        # solution would involve making sure we aren't stripping off intended nulls terminating the original data,
-        # but this works as a proof of concept.
+        # Remember that we padded the end of our original file with zeros, so we strip them off. Only the last bundle
+        # can contain padding, so it is the only one that needs stripping. A more intelligent solution would involve
+        # making sure we aren't stripping off intended nulls terminating the original data, but this works as a proof
+        # of concept.
 
         with open(args.output_directory + "/" + filename, "wb") as output_file:
-            with open("temp_outfile", "rb") as f:
-                output_file.write(f.read().rstrip(b'\0'))
-        os.remove("temp_outfile")
+            output_file.write(decoded_data[:-1])
+            output_file.write(decoded_data[-1].tobytes().rstrip(b'\0'))
 
         print(f"<decoder> writing finished!")
 
+    if failed:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
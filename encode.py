@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
 import os
-import random
 import math
 import numpy as np
 import gzip
-import json
 import argparse
 import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 """
 RATIONALE: A fountain code is a type of encoding process that allows the original data to be recovered from sufficiently
@@ -39,52 +39,169 @@ This encoder assumes that HDTN has a way of designating ordering information wit
 This encoder does not add any ordering information in its current iteration.
 """
 
+@functools.lru_cache(maxsize=16)
 def ideal_soliton(k):
     # The soliton probability distributions are designed to account for transmission errors by intelligently introducing
     # redundancy. Michael Luby, the namesake of Luby transform (LT) codes, is also the mastermind behind this algorithm.
     # A more robust version of this distribution exists and could be implemented later.
     # https://en.wikipedia.org/wiki/Erasure_code
     # https://en.wikipedia.org/wiki/Soliton_distribution
-    dist = [0, 1 / k]
-    for i in range(2, k + 1):
-        dist.append(1 / (i * (i - 1)))
+    i = np.arange(2, k + 1, dtype=np.float64)
+    dist = np.empty(k + 1)
+    dist[0] = 0
+    dist[1] = 1 / k
+    dist[2:] = 1 / (i * (i - 1))
+
+    # The distribution is cached per k, so it is made read-only to keep callers from modifying the shared copy.
+    dist.setflags(write=False)
     return dist
 
 
-def encode(bundles, original_size, encoded_size):
-    # Start by obtaining an ideal soliton probability distribution that will be used to generate xor neighbor values
-    # later.
-    ideal_dist = ideal_soliton(original_size)
-    xor_possibilities = []
+@functools.lru_cache(maxsize=16)
+def ideal_soliton_cdf(k):
+    # The cumulative distribution is normalized so that its last entry is exactly 1, which keeps floating point error
+    # from ever producing a number of xor neighbors greater than k when it is inverted with a binary search.
+    cum_dist = np.cumsum(ideal_soliton(k))
+    cum_dist /= cum_dist[-1]
+    cum_dist.setflags(write=False)
+    return cum_dist
+
+
+def sample_components(original_size, xor_neighbors, rng):
+    # Every encoded bundle needs xor_neighbors[i] distinct components. Rather than sampling them one bundle at a time,
+    # all components are drawn at once into a single flat array in compressed sparse row (CSR) layout: the components
+    # of encoded bundle i are comp_indices[comp_indptr[i]:comp_indptr[i + 1]]. The offsets and counts use np.intp,
+    # numpy's native index type, because np.repeat and reduceat only accept counts and offsets they can safely cast to
+    # it, and np.intp is only 32 bits wide on 32-bit platforms.
+    comp_indptr = np.zeros(len(xor_neighbors) + 1, dtype=np.intp)
+    np.cumsum(xor_neighbors, out=comp_indptr[1:])
+    comp_indices = rng.integers(original_size, size=comp_indptr[-1], dtype=np.int32)
+
+    # Drawing with replacement can repeat a component within a bundle. Each repeat is redrawn until every bundle's
+    # components are distinct, which takes only a few rounds as long as a bundle uses at most half of the original
+    # bundles. The rare bundles using more than that are sampled directly without replacement instead.
+    xor_neighbors = np.asarray(xor_neighbors, dtype=np.intp)
+    for i in np.flatnonzero(xor_neighbors > original_size // 2):
+        comp_indices[comp_indptr[i]:comp_indptr[i + 1]] = rng.choice(original_size, xor_neighbors[i], replace=False)
+
+    # Repeats are found by sorting (bundle, component) keys. Only the bundles that had a repeat redrawn in the previous
+    # round can still contain one, so every round after the first only sorts the components of those bundles.
+    checked = np.arange(len(xor_neighbors))
+    while len(checked):
+        counts = xor_neighbors[checked]
+        ends = np.cumsum(counts)
+        positions = np.arange(ends[-1]) + np.repeat(comp_indptr[checked] - (ends - counts), counts)
+        keys = np.repeat(checked.astype(np.int64), counts) * original_size + comp_indices[positions]
+        order = np.argsort(keys, kind="stable")
+        repeats = positions[order[1:]][keys[order[1:]] == keys[order[:-1]]]
+        comp_indices[repeats] = rng.integers(original_size, size=len(repeats), dtype=np.int32)
+        checked = np.unique(np.searchsorted(comp_indptr, repeats, side="right") - 1)
+
+    return comp_indptr, comp_indices
+
+
+def encode_rows(bundles, comp_indptr, comp_indices, encoded_values, start, stop):
+    # Narrow bundles make the per-bundle ufunc call, not the XOR itself, the dominant cost. For them, the XOR neighbors
+    # of many encoded bundles are gathered at once, at most 16 MiB at a time, and each encoded bundle's neighbors are
+    # XORed together by a single np.bitwise_xor.reduceat call over the whole gather.
+    if bundles[0].nbytes <= 256:
+        while start < stop:
+            block_stop = int(np.searchsorted(comp_indptr, comp_indptr[start] + (1 << 24) // bundles[0].nbytes,
+                                             side="right")) - 1
+            block_stop = min(max(block_stop, start + 1), stop)
+            first, last = comp_indptr[start], comp_indptr[block_stop]
+            np.bitwise_xor.reduceat(bundles[comp_indices[first:last]], comp_indptr[start:block_stop] - first, axis=0,
+                                    out=encoded_values[start:block_stop])
+            start = block_stop
+        return
+
+    # Otherwise, bundles are the rows of a single 2-D array, so the XOR neighbors can be gathered with one fancy index
+    # and XORed together with one ufunc call instead of one Python XOR per neighbor. The result is written straight into
+    # its row of encoded_values, so no array is allocated per encoded bundle.
+    for i in range(start, stop):
+        components = comp_indices[comp_indptr[i]:comp_indptr[i + 1]]
+        np.bitwise_xor.reduce(bundles[components], axis=0, out=encoded_values[i])
+
+
+def encode(bundles, original_size, encoded_size, rng):
+    # All randomness comes from the caller's numpy Generator rather than from the global random module, so no state is
+    # shared between concurrent encodes and a run can be reproduced by seeding the Generator.
 
-    for i in range(0, original_size + 1):
-        xor_possibilities.append(i)
+    # Start by obtaining an ideal soliton probability distribution that will be used to generate xor neighbor values
+    # later. Both distributions are cached, so encoding several files with the same number of bundles builds them once.
+    cum_dist = ideal_soliton_cdf(original_size)
 
-    # Encode data by cycling through our bundles and XORing them together to create encoded bundles. These bundles
-    # consist of an index number "index", the XORing result "value", an empty list of "components" to be used later,
-    # and the block's number of XOR neighbors "to_solve".
+    # Encode data by cycling through our bundles and XORing them together to create encoded bundles. The encoded
+    # bundles are returned as parallel arrays rather than one object per bundle: row i of encoded_values holds the
+    # XORing result of encoded bundle i, and its components are comp_indices[comp_indptr[i]:comp_indptr[i + 1]].
 
-    encoded_data = []
+    encoded_values = np.empty((encoded_size, bundles.shape[1]), dtype=bundles.dtype)
 
     # Randomly choosing a number of xor neighbors, even from a probability distribution, will likely lead to
     # unsolvable encoding, so to ensure that the encoding is solvable, we start by creating a bundle with one xor
     # neighbor. In this way, the xor neighbors distribution is slightly less ideal, but it is far more important
     # that the encoded data is solvable.
 
-    xor_neighbors = np.random.choice(xor_possibilities, size=(encoded_size - 1), p=ideal_dist).tolist()
-    # cur_xor_neighbors = np.random.choice(xor_possibilities, size=1, p=ideal_dist).tolist()[0]
+    # All numbers of xor neighbors are drawn at once by inverting the cumulative distribution with a binary search.
+    xor_neighbors = np.searchsorted(cum_dist, rng.random(encoded_size - 1), side="right").tolist()
     xor_neighbors.append(1)
 
-    for cur_xor_neighbors in xor_neighbors:
-        components = random.sample(range(original_size), cur_xor_neighbors)
-
-        cur_encode = bundles[components[0]]
-        for j in range(1, cur_xor_neighbors):
-            cur_encode = cur_encode ^ bundles[components[j]]
-
-        encoded_data.append(dict(value=cur_encode, components=components))
-
-    return encoded_data
+    comp_indptr, comp_indices = sample_components(original_size, xor_neighbors, rng)
+
+    # Every encoded bundle is independent of the others, so the encoded bundles are split into contiguous blocks that
+    # gather about the same number of bytes each, and the blocks are XORed in parallel. numpy releases the GIL while it
+    # gathers and XORs, so threads are enough to keep every core busy. A block is only worth a thread if it gathers at
+    # least 16 MiB, so small encodes use fewer threads, and one too small to split runs on the calling thread.
+    gathered_bytes = int(comp_indptr[-1]) * bundles[0].nbytes
+    workers = min(os.cpu_count() or 1, math.ceil(gathered_bytes / (1 << 24)))
+    if workers <= 1:
+        encode_rows(bundles, comp_indptr, comp_indices, encoded_values, 0, encoded_size)
+    else:
+        bounds = np.searchsorted(comp_indptr, np.linspace(0, comp_indptr[-1], workers + 1)).tolist()
+        bounds[0], bounds[-1] = 0, encoded_size
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(encode_rows, bundles, comp_indptr, comp_indices, encoded_values, start, stop)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+    return encoded_values, comp_indptr, comp_indices
+
+
+def write_bundles(f, encoded_values, comp_indptr, comp_indices, original_size, sent):
+    # Each bundle is framed by a small binary header holding its number of components, the length of its value in bytes
+    # and the number of original bundles, followed by the components and the raw bytes of the value, all as
+    # little-endian 32-bit words. Instead of writing every bundle with its own calls, the frames of many bundles are
+    # assembled at once in a single word array, at most 16 MiB at a time, and written with one call.
+    value_words = encoded_values[0].nbytes // 4
+    values = encoded_values.view("<u4")
+    sent = np.asarray(sent, dtype=np.intp)
+    counts = comp_indptr[sent + 1] - comp_indptr[sent]
+    frame_ends = np.cumsum(3 + counts + value_words)
+
+    block_start = 0
+    while block_start < len(sent):
+        block_base = frame_ends[block_start - 1] if block_start else 0
+        block_stop = int(np.searchsorted(frame_ends, block_base + (1 << 22), side="right"))
+        block_stop = min(max(block_stop, block_start + 1), len(sent))
+
+        block = sent[block_start:block_stop]
+        block_counts = counts[block_start:block_stop]
+        frame_starts = frame_ends[block_start:block_stop] - block_base - (3 + block_counts + value_words)
+        frames = np.empty(frame_ends[block_stop - 1] - block_base, dtype="<u4")
+
+        frames[frame_starts] = block_counts
+        frames[frame_starts + 1] = value_words * 4
+        frames[frame_starts + 2] = original_size
+
+        component_offsets = np.arange(block_counts.sum()) - np.repeat(np.cumsum(block_counts) - block_counts,
+                                                                        block_counts)
+        component_sources = np.repeat(comp_indptr[block], block_counts) + component_offsets
+        frames[np.repeat(frame_starts + 3, block_counts) + component_offsets] = comp_indices[component_sources]
+        frames[(frame_starts + 3 + block_counts)[:, None] + np.arange(value_words)] = values[block]
+
+        f.write(frames)
+        block_start = block_stop
 
 
 def main():
@@ -113,6 +230,8 @@ def main():
         for file in os.listdir(args.input_filename):
             file_list.append(os.path.join(args.input_filename, file))
 
+    rng = np.random.default_rng()
+
     print(f"<encoder> setup finished!")
 
     for filename in file_list:
@@ -126,6 +245,11 @@ def main():
             if BUNDLE_BYTES < 8:
                 raise argparse.ArgumentError("Minimum bundle size is 8 bytes")
 
+            # The whole file is read straight into rows of BUNDLE_BYTES bytes, so the rows must hold a whole number of
+            # DATATYPE elements.
+            if BUNDLE_BYTES % np.dtype(DATATYPE).itemsize != 0:
+                raise argparse.ArgumentError(None, f"Bundle size must be a multiple of {np.dtype(DATATYPE).itemsize} bytes")
+
             if REDUNDANCY < 1.3:
                 raise argparse.ArgumentError("Minimum redundancy scalar is 1.3")
 
@@ -140,56 +264,51 @@ def main():
             # Only really need to get the file extension in this simulated environment, data can be sent without extensions in
             # practice
             _, extension = os.path.splitext(os.path.abspath(input_file.name))
-            data = []
-
-            # Read the text file into bundles of predefined size specified by BUNDLE_BYTES above
-            for i in range(math.ceil(os.path.getsize(input_file_name) / BUNDLE_BYTES)):
-                byte_array = input_file.read(BUNDLE_BYTES)
-                # Testfile is transformed into an object of type bytearray so that it can be parsed by np.frombuffer later.
-                # Just in case our text file does not have an exact multiple of BUNDLE_BYTES bytes (it probably doesn't) pad the
-                # end of the last byte with zeros. This slightly increases the size of the original data, but it is necessary to
-                # make it play nicely with the encoding and decoding process of LT code
-
-                byte_array = byte_array.ljust(BUNDLE_BYTES, b'\x00')
-
-                # np.frombuffer takes our bytearray and interprets it as a buffer of elements of a specific type. The default
-                # value for dtype is float, but since LT code uses XORs, it would be better to interpret these elements as
-                # integers. The magic of how exactly these values are translated to unsigned 64 bit integers is handled by
-                # numpy. If we want to forgo using any python packages (helpful if someone ever translates this to C), we will
-                # need to uncover said magic methods.
 
-                byte_array = np.frombuffer(byte_array, dtype=DATATYPE)
-                data.append(byte_array)
+            # All bundles live in one contiguous 2-D array with one row of BUNDLE_BYTES bytes per bundle, so XORs during
+            # encoding operate on whole rows of a single allocation. Just in case our text file does not have an exact
+            # multiple of BUNDLE_BYTES bytes (it probably doesn't), the array is allocated with zeros and the file is
+            # read straight into it, which pads the end of the last bundle with zeros. This slightly increases the size
+            # of the original data, but it is necessary to make it play nicely with the encoding and decoding process of
+            # LT code.
+
+            # Viewing the bytes as an array of a specific type interprets them as elements of that type. Since LT code
+            # uses XORs, it is best to interpret these elements as unsigned integers. The magic of how exactly these
+            # values are translated to unsigned 64 bit integers is handled by numpy. If we want to forgo using any
+            # python packages (helpful if someone ever translates this to C), we will need to uncover said magic methods.
+            bundle_count = math.ceil(os.path.getsize(input_file_name) / BUNDLE_BYTES)
+            data = np.zeros((bundle_count, BUNDLE_BYTES // np.dtype(DATATYPE).itemsize), dtype=DATATYPE)
+            input_file.readinto(data)
 
         # For debugging purposes, we can output all our data sets. Could be added to a verbose option in the future.
         #print(f"ORIGINAL DATA: \n{data}")
         print(f"<encoder> reading finished!\n<encoder> encoding {filename}...")
 
         start = time.time()
-        encoded_data = encode(data, len(data), round(REDUNDANCY * len(data)))  # Redundancy is introduced here
+        encoded_values, comp_indptr, comp_indices = encode(data, len(data), round(REDUNDANCY * len(data)), rng)  # Redundancy is introduced here
         end = time.time()
         print(f"<encoder> data encoded! elapsed time: {round((end - start) * 1000,1)} ms\n<encoder> writing encoded data to {args.output_directory}/encodefile_{os.path.basename(filename)}.gz...")
-        # print(f"\n\n\nENCODED DATA: \n{encoded_data}")
+        # print(f"\n\n\nENCODED DATA: \n{encoded_values}")
 
 
-        # Simulate data loss, if necessary
+        # Simulate data loss, if necessary, by only sending a random sample of the encoded bundles
+        sent = range(len(encoded_values))
         if TRANSMISSION_LOSS_PERCENTAGE > 0.0:
-            encoded_data = random.sample(encoded_data, round(len(encoded_data) * (100 - TRANSMISSION_LOSS_PERCENTAGE) / 100))
+            sent = rng.choice(len(encoded_values), round(len(encoded_values) * (100 - TRANSMISSION_LOSS_PERCENTAGE) / 100),
+                              replace=False)
 
-        # Write each bundle to the temporary output file. Since HDTN will be fragmenting this encoded file into bundles,
-        # we should not write these bundles to the file all at once in a unified data structure like a list.
-        # As long as each bundle is surrounded by curly braces {}, the decoder can recover them using regex.
+        # Write each bundle to the output file. Since HDTN will be fragmenting this encoded file into bundles, we should
+        # not write these bundles to the file all at once in a unified data structure like a list, so every bundle keeps
+        # its own binary frame. This lets the decoder recover every bundle with np.frombuffer instead of parsing text.
+        # XOR-mixed bundles are close to incompressible, so the fastest compression level gives nearly the same file
+        # size as the default at a fraction of the CPU time.
 
         if not os.path.exists(args.output_directory):
             os.makedirs(args.output_directory)
 
-        with gzip.open(args.output_directory + "/encodefile_" + os.path.basename(filename) + ".gz", "wb") as f:
-            for bundle in encoded_data:
-                # For the purposes of reading these bundles later, we should write them with lists instead of numpy arrays.
-                # The lists are converted back into numpy arrays by the decoder.
-                bundle["value"] = bundle["value"].tolist()
-                to_write = json.dumps(bundle).encode()
-                f.write(to_write)
+        with gzip.open(args.output_directory + "/encodefile_" + os.path.basename(filename) + ".gz", "wb",
+                       compresslevel=1) as f:
+            write_bundles(f, encoded_values, comp_indptr, comp_indices, len(data), sent)
 
         print(f"<encoder> writing finished!")
 